@@ -1,10 +1,23 @@
+# Patch the standard library before sqlite3, paho and Flask are imported so
+# every socket and background task runs on the gevent event loop
+from gevent import monkey
+monkey.patch_all()
+
 import os
-import json
+import atexit
+import logging
+import queue
 import sqlite3
 import threading
+import time
+import msgpack
+import orjson
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template, request
+from flask_socketio import SocketIO, emit, join_room
 import paho.mqtt.client as mqtt
 import google.generativeai as genai
 from dotenv import load_dotenv
@@ -12,9 +25,12 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+log = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'smart_home_secret_key_2024'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
 
 # MQTT Configuration
 MQTT_BROKER = "localhost"
@@ -26,143 +42,514 @@ MQTT_TOPICS = {
     'energy_data': 'smarthome/+/energy'
 }
 
+# Gemini Configuration
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_MODEL = 'gemini-1.5-flash'
+DEVICE_CONTEXT_TTL = 30  # seconds before the AI device list is rebuilt
+GEMINI_SYSTEM_PROMPT = """
+You are a smart home assistant. Each request lists the available devices
+followed by the user's command. Reply with the device control actions to
+run and a short human-readable response.
+
+For lights: power, brightness 0-100
+For fans: power, speed 0-5
+For AC: power, temperature 16-30, mode
+"""
+
+# Structured output contract; Gemini is constrained to return exactly this shape
+GEMINI_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'actions': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'device_id': {'type': 'string'},
+                    'command': {
+                        'type': 'object',
+                        'properties': {
+                            'power': {'type': 'string', 'format': 'enum', 'enum': ['on', 'off']},
+                            'brightness': {'type': 'integer'},
+                            'speed': {'type': 'integer'},
+                            'temperature': {'type': 'integer'},
+                            'mode': {'type': 'string', 'format': 'enum', 'enum': ['cool', 'heat', 'auto']}
+                        }
+                    }
+                },
+                'required': ['device_id', 'command']
+            }
+        },
+        'response': {'type': 'string'}
+    },
+    'required': ['actions', 'response']
+}
+
+# The static prompt is sent as a system instruction so only the device list
+# and the command change between requests. The REST transport goes through
+# the gevent-patched sockets; the default gRPC transport is not gevent-aware
+# and would block the whole event loop for each Gemini round-trip
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY, transport='rest')
+gemini_model = genai.GenerativeModel(
+    GEMINI_MODEL,
+    system_instruction=GEMINI_SYSTEM_PROMPT,
+    generation_config={
+        'response_mime_type': 'application/json',
+        'response_schema': GEMINI_RESPONSE_SCHEMA
+    }
+)
+
+# SocketIO Configuration
+SECURITY_ROOM = 'security'   # room that receives security alerts
+BROADCAST_INTERVAL = 0.05    # seconds between coalesced device_updates emits
+BROADCAST_CHUNK_SIZE = 50    # max updates per device_updates message
+
+# Database Configuration
+DB_PATH = 'smart_home.db'
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+)
+DB_READ_POOL_SIZE = 8        # read-only connections shared by HTTP handlers
+WRITE_FLUSH_INTERVAL = 0.05  # seconds between batched commits
+WRITE_BATCH_SIZE = 500       # queued rows that trigger an early flush
+WRITE_QUEUE_LIMIT = 10000    # oldest rows are dropped beyond this backlog
+TIMESTAMP_RESOLUTION = 0.1   # seconds an event timestamp string is reused
+
+# SQL statements, kept as constants so every call site reuses the same
+# prepared statement from the connection's statement cache
+SQL_DEVICE_INSERT = '''
+    INSERT INTO devices (id, name, type, room, status, config) 
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SQL_STATUS_UPDATE = '''
+    UPDATE devices SET status = ?, last_seen = CURRENT_TIMESTAMP 
+    WHERE id = ?
+'''
+SQL_LOG_INSERT = '''
+    INSERT INTO device_logs (device_id, action, value) 
+    VALUES (?, ?, ?)
+'''
+SQL_ENERGY_INSERT = '''
+    INSERT INTO energy_consumption (device_id, power_watts) 
+    VALUES (?, ?)
+'''
+SQL_SECURITY_INSERT = '''
+    INSERT INTO security_events (sensor_id, event_type, description) 
+    VALUES (?, ?, ?)
+'''
+
 # Global variables
 mqtt_client = None
 devices = {}
+device_rooms = {}  # device_id -> room, used to route SocketIO updates
+_control_topics = {}  # device_id -> MQTT control topic, filled on first use
 sensor_data = {}
 
+# SQLite connections: readers borrow from the pool, the writer task owns its own
+_read_pool = queue.Queue(maxsize=DB_READ_POOL_SIZE)
+_writer_conn = None
+
+# Pending UI updates, drained by the SocketIO broadcaster
+_pending_updates = {}  # room -> {device_id: latest payload}
+_pending_lock = threading.Lock()
+
+# Pending writes, drained by the database writer task
+_status_updates = {}  # device_id -> latest status in this batch window
+_status_lock = threading.Lock()
+_log_q = deque(maxlen=WRITE_QUEUE_LIMIT)
+_energy_q = deque(maxlen=WRITE_QUEUE_LIMIT)
+_security_q = deque(maxlen=WRITE_QUEUE_LIMIT)
+_flush_event = threading.Event()
+_dropped_rows = 0  # rows evicted from full write queues since the last warning
+_dropped_lock = threading.Lock()
+
+# Cached "Available devices" section of the AI prompt
+_device_ctx_cache = {'text': None, 'ts': 0}
+_device_ctx_lock = threading.Lock()
+
+# Last formatted event timestamp as [epoch seconds, ISO string]
+_iso_cache = [0.0, '']
+
+def _open_conn(read_only=False):
+    """Open a long-lived SQLite connection with the WAL pragmas applied"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute('PRAGMA query_only=ON')
+    return conn
+
+def get_writer_conn():
+    """Return the single connection used for writes, opening it on first use"""
+    global _writer_conn
+    if _writer_conn is None:
+        _writer_conn = _open_conn()
+    return _writer_conn
+
+def init_read_pool():
+    """Pre-open the read-only connections handed out by borrow_conn()"""
+    while not _read_pool.full():
+        _read_pool.put(_open_conn(read_only=True))
+
+@contextmanager
+def borrow_conn():
+    """Borrow a read-only connection from the pool, waiting if all are in use"""
+    conn = _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+# Logging
+def init_logging():
+    """Send log records through a queue so hot paths never block on stderr"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+
 # Database initialization
 def init_database():
     """Initialize SQLite database for device management and logging"""
-    conn = sqlite3.connect('smart_home.db')
-    cursor = conn.cursor()
-    
-    # Devices table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS devices (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            type TEXT NOT NULL,
-            room TEXT NOT NULL,
-            status TEXT DEFAULT 'offline',
-            last_seen TIMESTAMP,
-            config TEXT
-        )
-    ''')
-    
-    # Device logs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS device_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT,
-            action TEXT,
-            value TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (device_id) REFERENCES devices (id)
-        )
-    ''')
-    
-    # Energy consumption table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS energy_consumption (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT,
-            power_watts REAL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (device_id) REFERENCES devices (id)
-        )
-    ''')
+    with get_writer_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        # Devices table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                room TEXT NOT NULL,
+                status TEXT DEFAULT 'offline',
+                last_seen TIMESTAMP,
+                config TEXT
+            )
+        ''')
+        
+        # Device logs table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT,
+                action TEXT,
+                value TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (device_id) REFERENCES devices (id)
+            )
+        ''')
+        
+        # Energy consumption table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS energy_consumption (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT,
+                power_watts REAL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (device_id) REFERENCES devices (id)
+            )
+        ''')
+        
+        # Security events table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS security_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sensor_id TEXT,
+                event_type TEXT,
+                description TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Indexes for the dashboard queries; the energy index also covers
+        # power_watts so the daily summary never reads the table itself
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sec_ts ON security_events (timestamp DESC)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_energy_dev_ts
+            ON energy_consumption (device_id, timestamp, power_watts)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_logs_dev_ts ON device_logs (device_id, timestamp)')
+        
+        # Insert sample devices if none exist
+        cursor.execute('SELECT COUNT(*) FROM devices')
+        if cursor.fetchone()[0] == 0:
+            sample_devices = [
+                ('living_room_light', 'Living Room Light', 'light', 'living_room', 'offline', '{"brightness": 100}'),
+                ('living_room_fan', 'Living Room Fan', 'fan', 'living_room', 'offline', '{"speed": 0}'),
+                ('bedroom_light', 'Bedroom Light', 'light', 'bedroom', 'offline', '{"brightness": 100}'),
+                ('bedroom_ac', 'Bedroom AC', 'ac', 'bedroom', 'offline', '{"temperature": 24, "mode": "cool"}'),
+                ('kitchen_light', 'Kitchen Light', 'light', 'kitchen', 'offline', '{"brightness": 100}'),
+                ('motion_sensor_entrance', 'Entrance Motion Sensor', 'motion_sensor', 'entrance', 'offline', '{}'),
+            ]
+            
+            cursor.executemany(SQL_DEVICE_INSERT, sample_devices)
+        
+        cursor.execute('SELECT id, room FROM devices')
+        device_rooms.update((row['id'], row['room']) for row in cursor)
     
-    # Security events table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS security_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sensor_id TEXT,
-            event_type TEXT,
-            description TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    init_read_pool()
+    invalidate_device_context()
+
+def get_device_context():
+    """Return the device list for AI prompts, rebuilding it once DEVICE_CONTEXT_TTL expires"""
+    with _device_ctx_lock:
+        if _device_ctx_cache['text'] is None or time.time() - _device_ctx_cache['ts'] > DEVICE_CONTEXT_TTL:
+            with borrow_conn() as conn:
+                device_list = conn.execute('SELECT id, name, type, room FROM devices').fetchall()
+            
+            context = "Available devices:\n"
+            for device in device_list:
+                context += f"- {device['name']} (ID: {device['id']}, Type: {device['type']}, Room: {device['room']})\n"
+            
+            _device_ctx_cache['text'] = context
+            _device_ctx_cache['ts'] = time.time()
+        return _device_ctx_cache['text']
+
+def invalidate_device_context():
+    """Force the next AI prompt to rebuild the device list"""
+    with _device_ctx_lock:
+        _device_ctx_cache['text'] = None
+
+# Batched database writes
+def _count_dropped(count):
+    """Record rows evicted from a full write queue"""
+    global _dropped_rows
+    with _dropped_lock:
+        _dropped_rows += count
+
+def _take_dropped():
+    """Return and reset the number of rows dropped since the last call"""
+    global _dropped_rows
+    with _dropped_lock:
+        dropped, _dropped_rows = _dropped_rows, 0
+    return dropped
+
+def enqueue_write(pending, row):
+    """Queue a row for the writer thread, waking it early once a batch is full"""
+    # A full deque silently evicts its oldest row on append, so count it
+    if len(pending) == pending.maxlen:
+        _count_dropped(1)
+    pending.append(row)
+    if len(pending) >= WRITE_BATCH_SIZE:
+        _flush_event.set()
+
+def _drain(pending, collapse_repeats=False):
+    """Pop every row currently queued, optionally dropping consecutive duplicate status logs"""
+    batch = []
+    while pending:
+        row = pending.popleft()
+        # Control-command audit rows share this queue and are always kept
+        if collapse_repeats and row[1] == 'status_update' and batch and batch[-1] == row:
+            continue
+        batch.append(row)
+    return batch
+
+def _requeue(pending, rows):
+    """Put rows back at the front of their queue, keeping their original order"""
+    for row in reversed(rows):
+        # appendleft on a full deque evicts the newest row instead
+        if len(pending) == pending.maxlen:
+            _count_dropped(1)
+        pending.appendleft(row)
+
+def _requeue_status_updates(updates):
+    """Merge undelivered statuses back without overwriting newer ones"""
+    with _status_lock:
+        for device_id, status in updates.items():
+            _status_updates.setdefault(device_id, status)
+
+def _drain_status_updates():
+    """Take the latest status per device and start a new batch window"""
+    global _status_updates
+    with _status_lock:
+        updates, _status_updates = _status_updates, {}
+    return updates
+
+def _write_batch(batches, isolate_rows=False):
+    """Run every (sql, rows) pair in one write transaction
+
+    With isolate_rows, rows are executed one at a time and any that SQLite
+    rejects outright are logged and discarded instead of failing the batch.
+    """
+    # BEGIN IMMEDIATE takes the write lock up front, so the batch never has
+    # to upgrade a read transaction while readers hold the database
+    with get_writer_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        for sql, rows in batches:
+            if not rows:
+                continue
+            if not isolate_rows:
+                cursor.executemany(sql, rows)
+                continue
+            for row in rows:
+                try:
+                    cursor.execute(sql, row)
+                except sqlite3.OperationalError:
+                    raise
+                except sqlite3.Error as e:
+                    log.error("Discarding unwritable row %r: %s", row, e)
+
+def flush_writes():
+    """Persist all queued rows in a single transaction"""
+    status_updates = _drain_status_updates()
+    log_rows = _drain(_log_q, collapse_repeats=True)
+    energy_rows = _drain(_energy_q)
+    security_rows = _drain(_security_q)
+    if not (status_updates or log_rows or energy_rows or security_rows):
+        return
     
-    # Insert sample devices if none exist
-    cursor.execute('SELECT COUNT(*) FROM devices')
-    if cursor.fetchone()[0] == 0:
-        sample_devices = [
-            ('living_room_light', 'Living Room Light', 'light', 'living_room', 'offline', '{"brightness": 100}'),
-            ('living_room_fan', 'Living Room Fan', 'fan', 'living_room', 'offline', '{"speed": 0}'),
-            ('bedroom_light', 'Bedroom Light', 'light', 'bedroom', 'offline', '{"brightness": 100}'),
-            ('bedroom_ac', 'Bedroom AC', 'ac', 'bedroom', 'offline', '{"temperature": 24, "mode": "cool"}'),
-            ('kitchen_light', 'Kitchen Light', 'light', 'kitchen', 'offline', '{"brightness": 100}'),
-            ('motion_sensor_entrance', 'Entrance Motion Sensor', 'motion_sensor', 'entrance', 'offline', '{}'),
-        ]
+    batches = [
+        (SQL_STATUS_UPDATE, [(status, device_id) for device_id, status in status_updates.items()]),
+        (SQL_LOG_INSERT, log_rows),
+        (SQL_ENERGY_INSERT, energy_rows),
+        (SQL_SECURITY_INSERT, security_rows),
+    ]
+    try:
+        try:
+            _write_batch(batches)
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.Error as e:
+            # A row SQLite can never accept (bad type, constraint) would fail
+            # every retry; replay row by row so only the bad ones are lost
+            log.error("Error flushing database writes, isolating bad rows: %s", e)
+            _write_batch(batches, isolate_rows=True)
+    except sqlite3.OperationalError as e:
+        # Locked/busy: the transaction was rolled back, retry the whole batch next flush
+        row_count = len(status_updates) + len(log_rows) + len(energy_rows) + len(security_rows)
+        log.error("Error flushing database writes, re-queued %d rows: %s", row_count, e)
+        _requeue_status_updates(status_updates)
+        _requeue(_log_q, log_rows)
+        _requeue(_energy_q, energy_rows)
+        _requeue(_security_q, security_rows)
+
+def db_writer_loop():
+    """Commit queued writes every WRITE_FLUSH_INTERVAL, or sooner when a batch fills"""
+    while True:
+        _flush_event.wait(WRITE_FLUSH_INTERVAL)
+        _flush_event.clear()
+        try:
+            flush_writes()
+        except Exception as e:
+            log.error("Error flushing database writes: %s", e)
         
-        cursor.executemany('''
-            INSERT INTO devices (id, name, type, room, status, config) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', sample_devices)
+        dropped = _take_dropped()
+        if dropped:
+            log.warning("Write queue full (limit %d), dropped %d rows", WRITE_QUEUE_LIMIT, dropped)
+
+def init_db_writer():
+    """Start the background database writer"""
+    socketio.start_background_task(db_writer_loop)
+    # Persist whatever is still queued when the process exits
+    atexit.register(flush_writes)
+
+# Coalesced SocketIO broadcasts
+def queue_device_update(device_id, payload):
+    """Queue a device update for the next broadcast, replacing any pending one"""
+    with _pending_lock:
+        _pending_updates.setdefault(device_rooms.get(device_id), {})[device_id] = {
+            'device_id': device_id,
+            'data': payload
+        }
+
+def broadcast_pending_updates():
+    """Emit one device_updates array per room, yielding between chunks"""
+    global _pending_updates
+    with _pending_lock:
+        pending, _pending_updates = _pending_updates, {}
     
-    conn.commit()
-    conn.close()
+    # Devices with no known room (None) are broadcast to everyone
+    for room, updates in pending.items():
+        updates = list(updates.values())
+        for start in range(0, len(updates), BROADCAST_CHUNK_SIZE):
+            socketio.emit('device_updates', updates[start:start + BROADCAST_CHUNK_SIZE], room=room)
+            socketio.sleep(0)
+
+def broadcaster_loop():
+    """Flush pending device updates every BROADCAST_INTERVAL"""
+    while True:
+        socketio.sleep(BROADCAST_INTERVAL)
+        try:
+            broadcast_pending_updates()
+        except Exception as e:
+            log.error("Error broadcasting device updates: %s", e)
+
+def init_broadcaster():
+    """Start the background SocketIO broadcaster"""
+    socketio.start_background_task(broadcaster_loop)
 
 # MQTT Functions
-def on_mqtt_connect(client, userdata, flags, rc):
+def _now_iso():
+    """Return the current time in ISO format, re-formatted at most every TIMESTAMP_RESOLUTION"""
+    now = time.time()
+    if now - _iso_cache[0] > TIMESTAMP_RESOLUTION:
+        _iso_cache[:] = [now, datetime.fromtimestamp(now).isoformat()]
+    return _iso_cache[1]
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties):
     """Callback for MQTT connection"""
-    if rc == 0:
-        print("Connected to MQTT broker")
+    if not reason_code.is_failure:
+        log.info("Connected to MQTT broker")
         # Subscribe to all device topics
         for topic in MQTT_TOPICS.values():
             client.subscribe(topic)
         socketio.emit('mqtt_status', {'connected': True})
     else:
-        print(f"Failed to connect to MQTT broker: {rc}")
+        log.error("Failed to connect to MQTT broker: %s", reason_code)
+
+def decode_payload(raw):
+    """Decode device telemetry sent as msgpack, or as JSON by hand-written clients"""
+    # A msgpack map never starts with '{' or whitespace, so JSON objects
+    # (including pretty-printed ones) are easy to tell apart
+    if raw.lstrip()[:1] == b'{':
+        return orjson.loads(raw)
+    return msgpack.unpackb(raw, raw=False)
 
 def on_mqtt_message(client, userdata, msg):
     """Handle incoming MQTT messages"""
     try:
-        topic = msg.topic
-        payload = json.loads(msg.payload.decode())
-        
-        # Extract device ID from topic
-        topic_parts = topic.split('/')
-        device_id = topic_parts[1] if len(topic_parts) > 1 else None
-        
-        if 'status' in topic:
-            handle_device_status(device_id, payload)
-        elif 'sensor' in topic:
-            handle_sensor_data(device_id, payload)
-        elif 'energy' in topic:
-            handle_energy_data(device_id, payload)
+        # Topics are smarthome/<device_id>/<kind>; split once and dispatch on
+        # <kind>, skipping the payload decode for kinds we don't handle
+        topic_parts = msg.topic.split('/', 2)
+        if len(topic_parts) == 3:
+            handler = MQTT_HANDLERS.get(topic_parts[2])
+            if handler:
+                handler(topic_parts[1], decode_payload(msg.payload))
             
     except Exception as e:
-        print(f"Error processing MQTT message: {e}")
+        log.error("Error processing MQTT message: %s", e)
 
 def handle_device_status(device_id, payload):
     """Handle device status updates"""
+    status = payload.get('status', 'online')
+    if status is not None and not isinstance(status, str):
+        log.warning("Ignoring status update from %s with non-string status %r", device_id, status)
+        return
+    
     if device_id:
+        # In-memory state and the UI update come first; persistence is
+        # write-behind and never delays what clients see
         devices[device_id] = payload
+        queue_device_update(device_id, payload)
         
-        # Update database
-        conn = sqlite3.connect('smart_home.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE devices SET status = ?, last_seen = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (payload.get('status', 'online'), device_id))
-        
-        # Log the status change
-        cursor.execute('''
-            INSERT INTO device_logs (device_id, action, value) 
-            VALUES (?, ?, ?)
-        ''', (device_id, 'status_update', json.dumps(payload)))
-        
-        conn.commit()
-        conn.close()
-        
-        # Broadcast to web clients
-        socketio.emit('device_update', {
-            'device_id': device_id,
-            'data': payload
-        })
+        # Later updates for the same device overwrite this one until the
+        # writer flushes; every status change is still logged
+        with _status_lock:
+            _status_updates[device_id] = status
+        enqueue_write(_log_q, (device_id, 'status_update', orjson.dumps(payload).decode()))
 
 def handle_sensor_data(device_id, payload):
     """Handle sensor data updates"""
@@ -171,38 +558,47 @@ def handle_sensor_data(device_id, payload):
         
         # Check for security events
         if payload.get('motion_detected'):
-            conn = sqlite3.connect('smart_home.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO security_events (sensor_id, event_type, description) 
-                VALUES (?, ?, ?)
-            ''', (device_id, 'motion_detected', 'Motion detected by sensor'))
-            conn.commit()
-            conn.close()
-            
-            # Broadcast security alert
+            # Broadcast security alert, then queue it for the database
             socketio.emit('security_alert', {
                 'sensor_id': device_id,
                 'event': 'motion_detected',
-                'timestamp': datetime.now().isoformat()
-            })
+                'timestamp': _now_iso()
+            }, room=SECURITY_ROOM)
+            enqueue_write(_security_q, (device_id, 'motion_detected', 'Motion detected by sensor'))
 
 def handle_energy_data(device_id, payload):
     """Handle energy consumption data"""
     if device_id and 'power_watts' in payload:
-        conn = sqlite3.connect('smart_home.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO energy_consumption (device_id, power_watts) 
-            VALUES (?, ?)
-        ''', (device_id, payload['power_watts']))
-        conn.commit()
-        conn.close()
+        # Coerce here so a malformed reading fails in this handler, not in
+        # the shared write transaction
+        enqueue_write(_energy_q, (device_id, float(payload['power_watts'])))
+
+# Incoming topic suffix -> handler
+MQTT_HANDLERS = {
+    'status': handle_device_status,
+    'sensor': handle_sensor_data,
+    'energy': handle_energy_data,
+}
+
+def control_topic(device_id):
+    """Return a device's MQTT control topic, formatting it once per known device"""
+    topic = _control_topics.get(device_id)
+    if topic is None:
+        topic = f"smarthome/{device_id}/control"
+        # Only cache registered devices so arbitrary API input can't grow the map
+        if device_id in device_rooms:
+            _control_topics[device_id] = topic
+    return topic
+
+def publish_commands(commands):
+    """Publish prebuilt (topic, payload) pairs back to back"""
+    for topic, payload in commands:
+        mqtt_client.publish(topic, payload)
 
 def init_mqtt():
     """Initialize MQTT client"""
     global mqtt_client
-    mqtt_client = mqtt.Client()
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqtt_client.on_connect = on_mqtt_connect
     mqtt_client.on_message = on_mqtt_message
     
@@ -210,9 +606,20 @@ def init_mqtt():
         mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
         mqtt_client.loop_start()
     except Exception as e:
-        print(f"Failed to connect to MQTT broker: {e}")
+        log.error("Failed to connect to MQTT broker: %s", e)
+
+def current_status(device_id, stored_status):
+    """Return a device's live status, which may be ahead of the database"""
+    payload = devices.get(device_id)
+    if payload is None:
+        return stored_status
+    return payload.get('status', 'online')
 
 # Flask Routes
+def json_response(payload, status=200):
+    """Build a JSON response with orjson instead of jsonify"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
 @app.route('/')
 def index():
     """Main dashboard"""
@@ -221,168 +628,109 @@ def index():
 @app.route('/api/devices')
 def get_devices():
     """Get all devices from database"""
-    conn = sqlite3.connect('smart_home.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, name, type, room, status, last_seen, config 
-        FROM devices
-    ''')
+    with borrow_conn() as conn:
+        cursor = conn.execute('''
+            SELECT id, name, type, room, status, last_seen, config 
+            FROM devices
+        ''')
+        devices_list = [{
+            'id': row['id'],
+            'name': row['name'],
+            'type': row['type'],
+            'room': row['room'],
+            'status': current_status(row['id'], row['status']),
+            'last_seen': row['last_seen'],
+            'config': orjson.loads(row['config']) if row['config'] else {}
+        } for row in cursor]
     
-    devices_list = []
-    for row in cursor.fetchall():
-        device = {
-            'id': row[0],
-            'name': row[1],
-            'type': row[2],
-            'room': row[3],
-            'status': row[4],
-            'last_seen': row[5],
-            'config': json.loads(row[6]) if row[6] else {}
-        }
-        devices_list.append(device)
-    
-    conn.close()
-    return jsonify(devices_list)
+    return json_response(devices_list)
 
 @app.route('/api/device/<device_id>/control', methods=['POST'])
 def control_device(device_id):
     """Control a specific device"""
     try:
-        command = request.json
+        command = orjson.loads(request.get_data())
+        command_json = orjson.dumps(command)
         
         # Publish MQTT command
-        topic = f"smarthome/{device_id}/control"
-        mqtt_client.publish(topic, json.dumps(command))
+        mqtt_client.publish(control_topic(device_id), command_json)
         
         # Log the command
-        conn = sqlite3.connect('smart_home.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO device_logs (device_id, action, value) 
-            VALUES (?, ?, ?)
-        ''', (device_id, 'control_command', json.dumps(command)))
-        conn.commit()
-        conn.close()
+        enqueue_write(_log_q, (device_id, 'control_command', command_json.decode()))
         
-        return jsonify({'success': True, 'message': 'Command sent'})
+        return json_response({'success': True, 'message': 'Command sent'})
         
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return json_response({'success': False, 'error': str(e)}, 500)
 
 @app.route('/api/energy/summary')
 def energy_summary():
     """Get energy consumption summary"""
-    conn = sqlite3.connect('smart_home.db')
-    cursor = conn.cursor()
-    
-    # Get today's consumption by device
-    cursor.execute('''
-        SELECT d.name, AVG(e.power_watts) as avg_power, MAX(e.power_watts) as peak_power
-        FROM energy_consumption e
-        JOIN devices d ON e.device_id = d.id
-        WHERE DATE(e.timestamp) = DATE('now')
-        GROUP BY d.id, d.name
-    ''')
-    
-    energy_data = []
-    for row in cursor.fetchall():
-        energy_data.append({
-            'device': row[0],
-            'avg_power': round(row[1] or 0, 2),
-            'peak_power': round(row[2] or 0, 2)
-        })
+    with borrow_conn() as conn:
+        # Get today's consumption by device
+        cursor = conn.execute('''
+            SELECT d.name, AVG(e.power_watts) as avg_power, MAX(e.power_watts) as peak_power
+            FROM energy_consumption e
+            JOIN devices d ON e.device_id = d.id
+            WHERE e.timestamp >= DATE('now', 'start of day')
+              AND e.timestamp < DATE('now', 'start of day', '+1 day')
+            GROUP BY d.id, d.name
+        ''')
+        energy_data = [{
+            'device': row['name'],
+            'avg_power': round(row['avg_power'] or 0, 2),
+            'peak_power': round(row['peak_power'] or 0, 2)
+        } for row in cursor]
     
-    conn.close()
-    return jsonify(energy_data)
+    return json_response(energy_data)
 
 @app.route('/api/security/events')
 def security_events():
     """Get recent security events"""
-    conn = sqlite3.connect('smart_home.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT sensor_id, event_type, description, timestamp
-        FROM security_events
-        ORDER BY timestamp DESC
-        LIMIT 10
-    ''')
-    
-    events = []
-    for row in cursor.fetchall():
-        events.append({
-            'sensor_id': row[0],
-            'event_type': row[1],
-            'description': row[2],
-            'timestamp': row[3]
-        })
+    with borrow_conn() as conn:
+        cursor = conn.execute('''
+            SELECT sensor_id, event_type, description, timestamp
+            FROM security_events
+            ORDER BY timestamp DESC
+            LIMIT 10
+        ''')
+        events = [dict(row) for row in cursor]
     
-    conn.close()
-    return jsonify(events)
+    return json_response(events)
 
 @app.route('/api/ai/command', methods=['POST'])
 def ai_command():
     """Process natural language commands using Gemini API"""
     try:
-        user_input = request.json.get('command', '')
-        
-        # Configure Gemini API (you'll need to set GEMINI_API_KEY in .env)
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            return jsonify({'success': False, 'error': 'Gemini API key not configured'})
-        
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # Get current device list for context
-        conn = sqlite3.connect('smart_home.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, name, type, room FROM devices')
-        device_list = cursor.fetchall()
-        conn.close()
+        user_input = orjson.loads(request.get_data()).get('command', '')
         
-        context = "Available devices:\n"
-        for device in device_list:
-            context += f"- {device[1]} (ID: {device[0]}, Type: {device[2]}, Room: {device[3]})\n"
+        # Gemini API key is read from GEMINI_API_KEY in .env at startup
+        if not GEMINI_API_KEY:
+            return json_response({'success': False, 'error': 'Gemini API key not configured'})
         
-        prompt = f"""
-        You are a smart home assistant. Based on this command: "{user_input}"
+        prompt = f'{get_device_context()}\nCommand: "{user_input}"'
         
-        {context}
-        
-        Generate a JSON response with device control commands. Format:
-        {{
-            "actions": [
-                {{"device_id": "device_id", "command": {{"action": "value"}}}}
-            ],
-            "response": "Human-readable response"
-        }}
-        
-        For lights: {{"power": "on/off", "brightness": 0-100}}
-        For fans: {{"power": "on/off", "speed": 0-5}}
-        For AC: {{"power": "on/off", "temperature": 16-30, "mode": "cool/heat/auto"}}
-        
-        Only return valid JSON.
-        """
-        
-        response = model.generate_content(prompt)
-        ai_response = json.loads(response.text)
+        # The response schema guarantees a bare JSON object with both keys
+        response = gemini_model.generate_content(prompt)
+        ai_response = orjson.loads(response.text)
         
         # Execute the actions
-        for action in ai_response.get('actions', []):
+        commands = []
+        for action in ai_response['actions']:
             device_id = action.get('device_id')
             command = action.get('command')
             if device_id and command:
-                topic = f"smarthome/{device_id}/control"
-                mqtt_client.publish(topic, json.dumps(command))
+                commands.append((control_topic(device_id), orjson.dumps(command)))
+        publish_commands(commands)
         
-        return jsonify({
+        return json_response({
             'success': True,
-            'response': ai_response.get('response', 'Commands executed'),
-            'actions': ai_response.get('actions', [])
+            'response': ai_response['response'],
+            'actions': ai_response['actions']
         })
         
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return json_response({'success': False, 'error': str(e)})
 
 # SocketIO Events
 @socketio.on('connect')
@@ -390,18 +738,30 @@ def handle_connect():
     """Handle client connection"""
     emit('connected', {'message': 'Connected to Smart Home Hub'})
 
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Join the rooms (e.g. 'living_room', 'security') the client wants updates for"""
+    for room in data.get('rooms', []):
+        join_room(room)
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    print('Client disconnected')
+    log.info('Client disconnected')
 
 if __name__ == '__main__':
+    init_logging()
     print("Initializing Smart Home Automation System...")
     
     # Initialize database
     init_database()
+    init_db_writer()
     print("✓ Database initialized")
     
+    # Start coalesced SocketIO broadcasts
+    init_broadcaster()
+    print("✓ SocketIO broadcaster started")
+    
     # Initialize MQTT
     init_mqtt()
     print("✓ MQTT client initialized")
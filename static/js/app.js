@@ -28,6 +28,7 @@ class SmartHomeHub {
             console.log('Connected to Smart Home Hub');
             document.getElementById('client-count').textContent = 'Connected';
             document.getElementById('client-count').className = 'status online';
+            this.subscribeRooms();
         });
 
         this.socket.on('disconnect', () => {
@@ -47,8 +48,8 @@ class SmartHomeHub {
             }
         });
 
-        this.socket.on('device_update', (data) => {
-            this.updateDeviceStatus(data.device_id, data.data);
+        this.socket.on('device_updates', (updates) => {
+            this.updateDeviceStatuses(updates);
         });
 
         this.socket.on('security_alert', (data) => {
@@ -104,11 +105,21 @@ class SmartHomeHub {
             });
             
             this.renderDevices();
+            this.subscribeRooms();
         } catch (error) {
             console.error('Error loading devices:', error);
         }
     }
 
+    subscribeRooms() {
+        // Device updates are only delivered to clients that joined the device's room
+        if (!this.socket.connected) return;
+
+        const rooms = new Set(Object.values(this.devices).map(device => device.room));
+        rooms.add('security');
+        this.socket.emit('subscribe', { rooms: Array.from(rooms) });
+    }
+
     renderDevices() {
         const grid = document.getElementById('devices-grid');
         grid.innerHTML = '';
@@ -358,9 +369,18 @@ class SmartHomeHub {
         this.renderDevices();
     }
 
-    updateDeviceStatus(deviceId, data) {
-        if (this.devices[deviceId]) {
-            this.devices[deviceId].status = data.status || 'online';
+    updateDeviceStatuses(updates) {
+        // Apply a batch of {device_id, data} updates and re-render once
+        let changed = false;
+        updates.forEach(update => {
+            const device = this.devices[update.device_id];
+            if (device) {
+                device.status = update.data.status || 'online';
+                changed = true;
+            }
+        });
+
+        if (changed) {
             this.renderDevices();
         }
     }
@@ -45,7 +45,7 @@ def test_mqtt_simulation():
         import paho.mqtt.client as mqtt
         import json
         
-        client = mqtt.Client()
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         client.connect("localhost", 1883, 60)
         
         # Test sending a command
@@ -4,12 +4,45 @@ Test script to simulate ESP32 devices for Smart Home Automation System
 This script creates virtual devices that respond to MQTT commands
 """
 
+import atexit
 import json
+import logging
+import queue
 import time
 import random
 import threading
+import msgpack
+import numpy as np
 import paho.mqtt.client as mqtt
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+log = logging.getLogger('virtual_devices')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+# Precomputed msgpack prefix of every status message
+STATUS_FIELDS_PACKED = msgpack.packb('status') + msgpack.packb('online') + msgpack.packb('timestamp')
+STATUS_FIELD_COUNT = 2
+
+# Energy simulation
+BASE_POWER_WATTS = {
+    'light': 10,
+    'fan': 50,
+    'ac': 800
+}
+STATUS_INTERVAL = 60  # seconds between fleet-wide status updates
+rng = np.random.default_rng()
+
+# Message timestamps
+TIMESTAMP_RESOLUTION = 0.1  # seconds a message timestamp string is reused
+_iso_cache = [0.0, '']  # last formatted timestamp as [epoch seconds, ISO string]
+
+# Shared MQTT connection
+CONTROL_TOPIC = 'smarthome/+/control'
+device_table = {}  # device_id -> VirtualDevice, used to route control messages
+device_lock = threading.Lock()  # guards device state between control messages and fleet ticks
+publish_stats = {'messages': 0, 'confirmed': 0, 'bytes': 0}
+stats_lock = threading.Lock()
 
 # Test device configurations
 TEST_DEVICES = {
@@ -45,62 +78,67 @@ TEST_DEVICES = {
     }
 }
 
+def compute_power_watts(devices):
+    """Simulate the power draw of many devices in one vectorized pass"""
+    count = len(devices)
+    base_power = np.empty(count)
+    factor = np.ones(count)
+    is_ac = np.zeros(count, dtype=bool)
+    
+    # Gather per-device settings into flat arrays
+    for i, device in enumerate(devices):
+        config = device.config
+        base_power[i] = BASE_POWER_WATTS[config['type']]
+        if config['type'] == 'light' and 'brightness' in config:
+            factor[i] = config['brightness'] / 100
+        elif config['type'] == 'fan' and 'speed' in config:
+            factor[i] = config['speed'] / 5
+        elif config['type'] == 'ac':
+            is_ac[i] = True
+    
+    # AC power varies with temperature difference; everything gets some
+    # random variation on top
+    ac_swing = np.where(is_ac, rng.integers(-100, 201, size=count), 0)
+    noise = rng.integers(-5, 6, size=count)
+    return np.maximum(0, base_power * factor + ac_swing + noise)
+
+def _now_iso():
+    """Return the current time in ISO format, re-formatted at most every TIMESTAMP_RESOLUTION"""
+    now = time.time()
+    if now - _iso_cache[0] > TIMESTAMP_RESOLUTION:
+        _iso_cache[:] = [now, datetime.fromtimestamp(now).isoformat()]
+    return _iso_cache[1]
+
 class VirtualDevice:
-    def __init__(self, device_id, config):
+    def __init__(self, device_id, config, mqtt_client):
         self.device_id = device_id
         self.config = config.copy()
-        self.mqtt_client = None
+        self.mqtt_client = mqtt_client  # connection shared by the whole fleet
+        self.topics = {
+            kind: f"smarthome/{device_id}/{kind}"
+            for kind in ('status', 'sensor', 'energy', 'control')
+        }
         self.running = False
-        
-    def connect_mqtt(self, broker='localhost', port=1883):
-        """Connect to MQTT broker"""
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_message = self.on_message
-        
-        try:
-            self.mqtt_client.connect(broker, port, 60)
-            self.mqtt_client.loop_start()
-            self.running = True
-            print(f"✓ {self.device_id} connected to MQTT broker")
-            return True
-        except Exception as e:
-            print(f"✗ {self.device_id} failed to connect: {e}")
-            return False
-    
-    def on_connect(self, client, userdata, flags, rc):
-        """Callback for MQTT connection"""
-        if rc == 0:
-            # Subscribe to control topic
-            control_topic = f"smarthome/{self.device_id}/control"
-            client.subscribe(control_topic)
-            print(f"✓ {self.device_id} subscribed to {control_topic}")
-            
-            # Send initial status
-            self.publish_status()
-        else:
-            print(f"✗ {self.device_id} connection failed with code {rc}")
-    
-    def on_message(self, client, userdata, msg):
-        """Handle incoming MQTT messages"""
-        try:
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode())
-            
-            if 'control' in topic:
-                self.handle_control_command(payload)
-        except Exception as e:
-            print(f"✗ {self.device_id} error processing message: {e}")
+        self._config_packed = None  # packed config pairs, reused until a command changes it
+        self._packer = msgpack.Packer()
+    
+    def publish(self, topic, payload):
+        """Publish a telemetry payload and account for its size on the wire"""
+        self.mqtt_client.publish(topic, payload)
+        with stats_lock:
+            publish_stats['messages'] += 1
+            publish_stats['bytes'] += len(payload)
     
     def handle_control_command(self, command):
         """Process control commands"""
-        print(f"📋 {self.device_id} received command: {command}")
+        log.info("📋 %s received command: %s", self.device_id, command)
         
         # Update device state based on command
         for key, value in command.items():
             if key in self.config:
                 self.config[key] = value
-                print(f"   → {key}: {value}")
+                self._config_packed = None
+                log.debug("   → %s: %s", key, value)
         
         # Publish updated status
         self.publish_status()
@@ -111,49 +149,34 @@ class VirtualDevice:
     
     def publish_status(self):
         """Publish device status"""
-        status_topic = f"smarthome/{self.device_id}/status"
-        status_data = {
-            'status': 'online',
-            'timestamp': datetime.now().isoformat(),
-            **self.config
-        }
+        if self._config_packed is None:
+            self._config_packed = b''.join(
+                msgpack.packb(key) + msgpack.packb(value) for key, value in self.config.items())
+        
+        # Same bytes as msgpack.packb({'status': 'online', 'timestamp': ..., **self.config})
+        status_packed = (self._packer.pack_map_header(STATUS_FIELD_COUNT + len(self.config))
+                         + STATUS_FIELDS_PACKED
+                         + msgpack.packb(_now_iso())
+                         + self._config_packed)
         
-        self.mqtt_client.publish(status_topic, json.dumps(status_data))
-        print(f"📤 {self.device_id} published status")
+        self.publish(self.topics['status'], status_packed)
+        log.debug("📤 %s published status", self.device_id)
     
-    def publish_energy_data(self):
+    def publish_energy_data(self, power_watts=None):
         """Publish simulated energy consumption data"""
-        if self.config['type'] in ['light', 'fan', 'ac']:
-            # Simulate power consumption based on device type and settings
-            base_power = {
-                'light': 10,
-                'fan': 50,
-                'ac': 800
-            }
-            
-            power_watts = base_power.get(self.config['type'], 0)
+        if self.config['type'] in BASE_POWER_WATTS:
+            # Fleet ticks pass in a precomputed value; single commands simulate here
+            if power_watts is None:
+                power_watts = compute_power_watts([self])[0]
+            power_watts = float(power_watts)
             
-            # Adjust power based on settings
-            if self.config['type'] == 'light' and 'brightness' in self.config:
-                power_watts = power_watts * (self.config['brightness'] / 100)
-            elif self.config['type'] == 'fan' and 'speed' in self.config:
-                power_watts = power_watts * (self.config['speed'] / 5)
-            elif self.config['type'] == 'ac':
-                # AC power varies with temperature difference
-                power_watts += random.randint(-100, 200)
-            
-            # Add some random variation
-            power_watts += random.randint(-5, 5)
-            power_watts = max(0, power_watts)
-            
-            energy_topic = f"smarthome/{self.device_id}/energy"
             energy_data = {
                 'power_watts': round(power_watts, 2),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': _now_iso()
             }
             
-            self.mqtt_client.publish(energy_topic, json.dumps(energy_data))
-            print(f"⚡ {self.device_id} energy: {power_watts:.1f}W")
+            self.publish(self.topics['energy'], msgpack.packb(energy_data))
+            log.debug("⚡ %s energy: %.1fW", self.device_id, power_watts)
     
     def simulate_motion_sensor(self):
         """Simulate motion sensor activity"""
@@ -163,65 +186,138 @@ class VirtualDevice:
                 
                 if random.random() < 0.3:  # 30% chance of motion
                     motion_detected = True
-                    print(f"👁️ {self.device_id} detected motion!")
+                    log.info("👁️ %s detected motion!", self.device_id)
                     
-                    sensor_topic = f"smarthome/{self.device_id}/sensor"
                     sensor_data = {
                         'motion_detected': motion_detected,
-                        'timestamp': datetime.now().isoformat()
+                        'timestamp': _now_iso()
                     }
                     
-                    self.mqtt_client.publish(sensor_topic, json.dumps(sensor_data))
+                    self.publish(self.topics['sensor'], msgpack.packb(sensor_data))
                     
                     # Reset motion after 5 seconds
                     time.sleep(5)
                     sensor_data['motion_detected'] = False
-                    self.mqtt_client.publish(sensor_topic, json.dumps(sensor_data))
+                    self.publish(self.topics['sensor'], msgpack.packb(sensor_data))
     
     def start_simulation(self):
         """Start device simulation"""
+        self.running = True
         if self.config['type'] == 'motion_sensor':
             motion_thread = threading.Thread(target=self.simulate_motion_sensor)
             motion_thread.daemon = True
             motion_thread.start()
-        
-        # Periodic status updates
-        status_thread = threading.Thread(target=self.periodic_status_update)
-        status_thread.daemon = True
-        status_thread.start()
-    
-    def periodic_status_update(self):
-        """Send periodic status updates"""
-        while self.running:
-            time.sleep(60)  # Status update every minute
-            if self.running:
-                self.publish_status()
-                
-                # Publish energy data for active devices
-                if self.config.get('power') == 'on':
-                    self.publish_energy_data()
     
     def stop(self):
         """Stop the device simulation"""
         self.running = False
-        if self.mqtt_client:
-            self.mqtt_client.loop_stop()
-            self.mqtt_client.disconnect()
-        print(f"🛑 {self.device_id} stopped")
+        log.info("🛑 %s stopped", self.device_id)
+
+def on_connect(client, userdata, flags, reason_code, properties):
+    """Callback for MQTT connection"""
+    if not reason_code.is_failure:
+        # One wildcard subscription covers every device's control topic
+        client.subscribe(CONTROL_TOPIC)
+        log.info("✓ Subscribed to %s", CONTROL_TOPIC)
+        
+        # Send initial status
+        with device_lock:
+            for device in device_table.values():
+                device.publish_status()
+    else:
+        log.error("✗ MQTT connection failed with code %s", reason_code)
+
+def on_message(client, userdata, msg):
+    """Route control messages to the addressed virtual device"""
+    try:
+        topic_parts = msg.topic.split('/', 2)
+        if len(topic_parts) == 3 and topic_parts[2] == 'control':
+            device = device_table.get(topic_parts[1])
+            if device:
+                payload = json.loads(msg.payload.decode())
+                with device_lock:
+                    device.handle_control_command(payload)
+    except Exception as e:
+        log.error("✗ Error processing message on %s: %s", msg.topic, e)
+
+def on_publish(client, userdata, mid, reason_code, properties):
+    """Count messages paho has handed to the broker"""
+    with stats_lock:
+        publish_stats['confirmed'] += 1
+
+def init_logging():
+    """Send log records through a queue so device threads never block on stderr"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+
+def create_mqtt_client():
+    """Create the MQTT client shared by all virtual devices"""
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_publish = on_publish
+    return client
+
+def connect_mqtt(client, broker='localhost', port=1883):
+    """Connect the shared client to the MQTT broker"""
+    try:
+        client.connect(broker, port, 60)
+        client.loop_start()
+        log.info("✓ Connected to MQTT broker")
+        return True
+    except Exception as e:
+        log.error("✗ Failed to connect: %s", e)
+        return False
+
+def publish_fleet_energy(devices):
+    """Publish energy data for every powered device from a single simulation pass"""
+    powered = [device for device in devices
+               if device.config.get('power') == 'on' and device.config['type'] in BASE_POWER_WATTS]
+    if powered:
+        for device, power_watts in zip(powered, compute_power_watts(powered)):
+            device.publish_energy_data(power_watts)
+
+def periodic_fleet_update():
+    """Send periodic status and energy updates for the whole fleet"""
+    while True:
+        time.sleep(STATUS_INTERVAL)
+        with device_lock:
+            active = [device for device in device_table.values() if device.running]
+            for device in active:
+                device.publish_status()
+            
+            # Publish energy data for active devices
+            publish_fleet_energy(active)
 
 def main():
     """Main function to run virtual device simulation"""
+    init_logging()
     print("🏠 Starting Virtual Smart Home Devices")
     print("=" * 50)
     
-    devices = []
+    client = create_mqtt_client()
     
     # Create virtual devices
     for device_id, config in TEST_DEVICES.items():
-        device = VirtualDevice(device_id, config)
-        if device.connect_mqtt():
-            device.start_simulation()
-            devices.append(device)
+        device_table[device_id] = VirtualDevice(device_id, config, client)
+    
+    if not connect_mqtt(client):
+        return
+    
+    for device in device_table.values():
+        device.start_simulation()
+    
+    # Periodic status updates for all devices
+    fleet_thread = threading.Thread(target=periodic_fleet_update)
+    fleet_thread.daemon = True
+    fleet_thread.start()
     
     print("\n✅ All virtual devices started successfully!")
     print("\nDevices are now listening for commands and sending status updates.")
@@ -236,9 +332,12 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\n\n🛑 Stopping all virtual devices...")
-        for device in devices:
+        for device in device_table.values():
             device.stop()
-        print("✅ All devices stopped")
+        client.loop_stop()
+        client.disconnect()
+        print(f"✅ All devices stopped ({publish_stats['confirmed']}/{publish_stats['messages']} "
+              f"messages confirmed, {publish_stats['bytes']} bytes sent)")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file